@@ -1,11 +1,11 @@
 from functools import partial
-import random
 import sys
 import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from . import exceptions
 from . import log
+from . import util
 from .lockingqueue import LockingQueue
 from .lock import Lock
 from .getset import GetSet
@@ -17,16 +17,22 @@ def _run_async(func, *args, **kwargs):
     t.start()
 
 
-def _map_async(func, *iterables):
-    tpe = ThreadPoolExecutor(sys.maxsize)
-    futures = [tpe.submit(func, *args) for args in zip(*iterables)]
+# Before python 3.8, ThreadPoolExecutor starts a new thread for every task
+# until it has max_workers threads, so only reuse an unbounded pool where idle
+# threads get reused too.
+_REUSE_POOL = sys.version_info >= (3, 8)
+
+
+def _map_async(pool, func, *iterables):
+    pool = pool or ThreadPoolExecutor(sys.maxsize)
+    futures = [pool.submit(func, *args) for args in zip(*iterables)]
     return (f.result() for f in as_completed(futures))
 
 
 class MajorityRedis(object):
     def __init__(self, clients, n_servers, lock_timeout=30, polling_interval=25,
-                 run_async=_run_async, map_async=_map_async,
-                 getset_history_prefix='', threadsafe=False):
+                 run_async=_run_async, map_async=None,
+                 getset_history_prefix='', threadsafe=False, multiplex=False):
         """Initializes MajorityRedis connection to multiple independent
         non-replicated Redis Instances.  This MajorityRedis client contains
         algorithms and operations based on majority vote of the redis servers.
@@ -53,7 +59,8 @@ class MajorityRedis(object):
             and runs it in the background.  run_async(func, *args, **kwargs)
             By default, uses Python's threading module.
         `map_async` - a function of form map(func, iterable) that maps func on
-            iterable sequence.  By default, uses Python's threading module.
+            iterable sequence.  By default, uses a thread pool that is created
+            once for this instance and grows to the number of calls in flight.
         `getset_history_prefix` - a prefix for a key that majorityredis uses to
             store the history of reads and writes to redis keys.
         `threadsafe` (bool) This applies to instances of Lock and LockingQueue.
@@ -62,8 +69,14 @@ class MajorityRedis(object):
           lock2 can unlock that same key.  If `threadsafe` is true, however,
           ownership is isolated to the instance, and lock2 cannot unlock
           lock1's locked keys.
+        `multiplex` (bool) If True, send each lua script to all servers from
+          the calling thread and read the replies as they arrive, rather
+          than using a thread per server.  `map_async` is still used for
+          everything else.  Connecting to a server also happens on the
+          calling thread, so this is best suited to stable connections.
         """
-        if len(clients) < n_servers // 2 + 1:
+        quorum = n_servers // 2 + 1
+        if len(clients) < quorum:
             raise exceptions.MajorityRedisException(
                 "Must connect to at least half of the redis servers to"
                 " obtain majority")
@@ -82,11 +95,20 @@ class MajorityRedis(object):
                 " polling_interval < lock_timeout."
                 " The socket_timeout is a config setting on your redis clients")
         self._run_async = run_async
-        self._client_id = random.randint(1, sys.maxsize)
+        self._client_id = util.new_client_id()
         self._clients = clients
         self._clock_drift = 0  # TODO
+        if map_async is None:
+            # Unbounded, so calls to a hung server, including ones nobody
+            # waits on anymore, can't use up the threads other calls need.
+            self._pool = ThreadPoolExecutor(sys.maxsize) if _REUSE_POOL \
+                else None
+            map_async = partial(_map_async, self._pool)
+        if multiplex:
+            map_async = util.MultiplexedMap(map_async, run_async)
         self._map_async = map_async
         self._n_servers = n_servers
+        self._quorum = quorum
         self._polling_interval = polling_interval
         self._lock_timeout = lock_timeout
         self._getset_history_prefix = getset_history_prefix
@@ -83,6 +83,9 @@ class GetSet(object):
         self._getset_hist_key = '%s%s' % (
             mr_client._getset_history_prefix, '.majorityredis_getset_history')
         self._mr = mr_client
+        util.load_scripts(
+            SCRIPTS, mr_client._map_async, mr_client._clients,
+            mr_client._quorum)
 
     def exists(self, path):
         """Return True if path exists.  False otherwise.
@@ -178,7 +181,7 @@ class GetSet(object):
         responses = []
         winner = (None, None)
         failed = []
-        quorum = self._mr._n_servers // 2 + 1
+        quorum = self._mr._quorum
         for client, val_ts in gen:
             if isinstance(val_ts, Exception):
                 failed.append((client, val_ts))
@@ -217,7 +220,7 @@ class GetSet(object):
             path=path, hist=self._getset_hist_key, ts=ts, **script_params)
         responses, winner, fail_cnt = self._parse_responses(gen)
 
-        if fail_cnt > self._mr._n_servers // 2:
+        if fail_cnt >= self._mr._quorum:
             if self._is_modify_path_consistent_given_error(responses):
                 return False  # state is consistent. didn't update anything
             raise exceptions.NoMajority(
@@ -247,9 +250,9 @@ class GetSet(object):
             if not isinstance(val_ts, Exception):
                 continue
             cnt[tuple(str(val_ts).split(':')[-2:])] += 1
-            if n + 1 < self._mr._n_servers // 2 + 1:
+            if n + 1 < self._mr._quorum:
                 continue
-            if any(val > self._mr._n_servers // 2 for val in cnt.values()):
+            if any(val >= self._mr._quorum for val in cnt.values()):
                 return True
         return False
 
@@ -271,7 +274,7 @@ class GetSet(object):
                 "Got errors from all redis servers")
         if heal:
             self._heal(path, responses, winner, fail_cnt)
-        if fail_cnt >= self._mr._n_servers // 2 + 1:
+        if fail_cnt >= self._mr._quorum:
             raise exceptions.NoMajority(
                 "Got errors from majority of redis servers")
         return winner[0]
@@ -1,4 +1,3 @@
-import random
 import sys
 import time
 
@@ -9,13 +8,10 @@ from . import exceptions
 SCRIPTS = dict(
 
     # returns 1 if locked, 0 if could not lock.
-    # return exception if invalid expireat (ie lock is already expired)
-    l_lock=dict(keys=('path', ), args=('client_id', 'expireat'), script="""
-if 1 == redis.call("SETNX", KEYS[1], ARGV[1]) then
-    if 1 == redis.call("EXPIREAT", KEYS[1], ARGV[2]) then return 1
-    else
-      redis.call("DEL", KEYS[1])
-      return {err="invalid expireat"} end
+    # return exception if invalid expireat or ttl (ie lock is already expired)
+    l_lock=dict(
+        keys=('path', ), args=('client_id', 'expireat', 'ttl'), script="""
+if redis.call("SET", KEYS[1], ARGV[1], "NX", "EX", ARGV[3]) then return 1
 elseif ARGV[1] == redis.call("GET", KEYS[1]) then
     if 1 ~= redis.call("EXPIREAT", KEYS[1], ARGV[2]) then
       redis.call("DEL", KEYS[1])
@@ -53,9 +49,12 @@ class Lock(object):
         `mr_client` - an instance of the MajorityRedis client.
         """
         self._mr = mr_client
+        util.load_scripts(
+            SCRIPTS, mr_client._map_async, mr_client._clients,
+            mr_client._quorum)
         self._lock_timeout = mr_client._lock_timeout
         if mr_client._threadsafe:
-            self._client_id = random.randint(1, sys.maxsize)
+            self._client_id = util.new_client_id()
         else:
             self._client_id = mr_client._client_id
 
@@ -125,13 +124,18 @@ class Lock(object):
         t_start, t_expireat = util.get_expireat(self._lock_timeout)
         locks = util.run_script(
             SCRIPTS, self._mr._map_async, 'l_lock', self._mr._clients,
-            path=path, client_id=self._client_id, expireat=t_expireat)
+            path=path, client_id=self._client_id, expireat=t_expireat,
+            ttl=util.get_ttl(t_start, t_expireat))
         n, locked_clients = 0, []
         for cli, is_locked in locks:
             if is_locked == 1:
                 n += 1
                 locked_clients.append(cli)
-        if n < self._mr._n_servers // 2 + 1:
+                if n >= self._mr._quorum:
+                    # the slower servers finish in the background.  run_script
+                    # still reads their replies and logs any errors.
+                    break
+        if n < self._mr._quorum:
             self.unlock(path, clients=locked_clients)
             return False
         if not util.lock_still_valid(
@@ -139,10 +143,20 @@ class Lock(object):
             return False
         if extend_lock:
             util.continually_extend_lock_in_background(
-                path, self.extend_lock, self._mr._polling_interval,
+                path, self._extend_lock_in_background,
+                self._mr._polling_interval,
                 self._mr._run_async, extend_lock, self._client_id)
         return t_expireat
 
+    def _extend_lock_in_background(self, path):
+        """Extend the lock, but return the number of seconds left on it,
+        which is what util.continually_extend_lock_in_background expects"""
+        t_expireat = self.extend_lock(path)
+        if not t_expireat:
+            return t_expireat
+        return util.lock_still_valid(
+            t_expireat, self._mr._clock_drift, self._mr._polling_interval)
+
     def unlock(self, path, clients=None):
         """Remove the lock at given `path` as long as the lock was created
         by this client.
@@ -167,11 +181,20 @@ class Lock(object):
             number of seconds since epoch in the future when lock will expire
         """
         t_start, t_expireat = util.get_expireat(self._lock_timeout)
-        locks = list(util.run_script(
+        locks = util.run_script(
             SCRIPTS, self._mr._map_async, 'l_extend_lock', self._mr._clients,
-            path=path, client_id=self._client_id, expireat=t_expireat))
-        cnt = sum(x[1] == 1 for x in locks)
-        if cnt < self._mr._n_servers // 2 + 1:
+            path=path, client_id=self._client_id, expireat=t_expireat)
+        cnt, lost_clients = 0, []
+        for cli, is_extended in locks:
+            if is_extended != 1:
+                lost_clients.append(cli)
+                continue
+            cnt += 1
+            if cnt >= self._mr._quorum:
+                # the slower servers finish in the background.  run_script
+                # still reads their replies and logs any errors.
+                break
+        if cnt < self._mr._quorum:
             return False
         # Re-lock nodes where lock is lost. By this point we have majority
         # However, there's a possible race condition if we lock all clients,
@@ -180,14 +203,20 @@ class Lock(object):
         # 2a l_extend_lock on all
         # 2b. unlock() on all
         # 2c. re-lock (via l_lock) on all
-        if util.lock_still_valid(
-                t_expireat, self._mr._clock_drift, self._mr._polling_interval):
+        # This wave only goes to the (usually empty) minority where the
+        # extend failed, and it must wait for majority to be known, so it
+        # cannot be queued in the same flush as l_extend_lock.
+        # Only check the clock again if the re-lock took time.
+        secs_left = util.lock_still_valid(
+            t_expireat, self._mr._clock_drift, self._mr._polling_interval)
+        if secs_left and lost_clients:
             # list(...) makes us block until response received from all servers
             list(util.run_script(
-                SCRIPTS, self._mr._map_async, 'l_lock',
-                [x[0] for x in locks if x[1] != 1],
-                path=path, client_id=self._client_id, expireat=t_expireat))
-        if util.lock_still_valid(
-                t_expireat, self._mr._clock_drift, self._mr._polling_interval):
+                SCRIPTS, self._mr._map_async, 'l_lock', lost_clients,
+                path=path, client_id=self._client_id, expireat=t_expireat,
+                ttl=util.get_ttl(t_start, t_expireat)))
+            secs_left = util.lock_still_valid(
+                t_expireat, self._mr._clock_drift, self._mr._polling_interval)
+        if secs_left:
             return t_expireat
         return False
@@ -1,10 +1,13 @@
 """
 Distributed Locking Queue for Redis adapted from the Redlock algorithm.
+
+Anything that must be atomic on a redis server belongs in one of the lua
+SCRIPTS below rather than in WATCH/MULTI/EXEC from the client.  A script costs
+one round trip and never has to be retried.
 """
 import random
-import sys
+import redis
 import time
-from itertools import chain
 
 from . import util
 from . import exceptions
@@ -15,36 +18,32 @@ from . import log
 SCRIPTS = dict(
     # keys:
     # h_k = ordered hash of key in form:  priority:insert_time_since_epoch:key
+    #       (insert time is in microseconds, zero-padded to 16 digits)
     # Q = sorted set of queued keys, h_k
     # Qi = sorted set mapping h_k to key for all known queued or completed items
     #
     # args:
     # expireat = seconds_since_epoch, presumably in the future
+    # ttl = seconds until a newly set lock expires, no earlier than expireat
     # client_id = unique owner of the lock
     # randint = a random integer that changes every time script is called
 
-    # returns 1
-    lq_put=dict(keys=('Q', 'h_k'), args=(), script="""
-redis.call("ZINCRBY", KEYS[1], 0, KEYS[2])
-return 1
-"""),
-
     # returns 1 if got an item, and returns an error otherwise
-    lq_get=dict(keys=('Q', ), args=('client_id', 'expireat'), script="""
+    lq_get=dict(keys=('Q', ), args=('client_id', 'ttl'), script="""
 local h_k = redis.call("ZRANGE", KEYS[1], 0, 0)[1]
 if nil == h_k then return {err="queue empty"} end
-if false == redis.call("SET", h_k, ARGV[1], "NX") then
+if false == redis.call("SET", h_k, ARGV[1], "NX", "EX", ARGV[2]) then
   return {err="already locked"} end
-if 1 ~= redis.call("EXPIREAT", h_k, ARGV[2]) then
-  return {err="invalid expireat"} end
 redis.call("ZINCRBY", KEYS[1], 1, h_k)
 return h_k
 """),
 
     # returns 1 if got lock. Returns an error otherwise
     lq_lock=dict(
-        keys=('h_k', 'Q'), args=('expireat', 'randint', 'client_id'), script="""
-if false == redis.call("SET", KEYS[1], ARGV[3], "NX") then  -- did not get lock
+        keys=('h_k', 'Q'), args=('expireat', 'randint', 'client_id', 'ttl'),
+        script="""
+if false == redis.call("SET", KEYS[1], ARGV[3], "NX", "EX", ARGV[4]) then
+  -- did not get lock
   local rv = redis.call("GET", KEYS[1])
   if rv == "completed" then
     redis.call("ZREM", KEYS[2], KEYS[1])
@@ -55,32 +54,32 @@ if false == redis.call("SET", KEYS[1], ARGV[3], "NX") then  -- did not get lock
     return 1
   else
     local score = tonumber(redis.call("ZSCORE", KEYS[2], KEYS[1]))
-    math.randomseed(tonumber(ARGV[2]))
-    local num = math.random(math.floor(score) + 1)
-    if num ~= 1 then
-      redis.call("ZINCRBY", KEYS[2], (num-1)/score, KEYS[1])
+    local num = tonumber(ARGV[2]) % (math.floor(score) + 1)
+    if num ~= 0 then
+      redis.call("ZINCRBY", KEYS[2], num/score, KEYS[1])
     end
     return {err="already locked"}
   end
 else
-  if 1 ~= redis.call("EXPIREAT", KEYS[1], ARGV[1]) then
-    return {err="invalid expireat"} end
   redis.call("ZINCRBY", KEYS[2], 1, KEYS[1])
   return 1
 end
 """),
 
-    # return 1 if extended lock.  Returns an error otherwise.
-    # otherwise
+    # return 1 if extended lock.  If the lock had expired, take it again
+    # and return 2.  Returns an error otherwise.
     lq_extend_lock=dict(
-        keys=('h_k', ), args=('expireat', 'client_id'), script="""
+        keys=('h_k', 'Q'), args=('expireat', 'client_id', 'ttl'), script="""
 local rv = redis.call("GET", KEYS[1])
 if ARGV[2] == rv then
     if 1 ~= redis.call("EXPIREAT", KEYS[1], ARGV[1]) then
       return {err="invalid expireat"} end
     return 1
 elseif "completed" == rv then return {err="already completed"}
-elseif false == rv then return {err="expired"}
+elseif false == rv then
+    redis.call("SET", KEYS[1], ARGV[2], "EX", ARGV[3])
+    redis.call("ZINCRBY", KEYS[2], 1, KEYS[1])
+    return 2
 else return {err="lock stolen"} end
 """),
 
@@ -89,8 +88,7 @@ else return {err="lock stolen"} end
         keys=('h_k', 'Q', 'Qi'), args=('client_id', ), script="""
 local rv = redis.pcall("GET", KEYS[1])
 if ARGV[1] == rv or "completed" == rv then
-  redis.call("SET", KEYS[1], "completed")
-  redis.call("PERSIST", KEYS[1])  -- or EXPIRE far into the future...
+  redis.call("SET", KEYS[1], "completed")  -- also clears the lock's ttl
   redis.call("ZREM", KEYS[2], KEYS[1])
   if "completed" ~= rv then redis.call("INCR", KEYS[3]) end
   return 1
@@ -102,8 +100,7 @@ else return 0 end
         keys=('h_k', 'Q', 'Qi'), args=(), script="""
 if "completed" ~= redis.call("GET", KEYS[1]) then
   redis.call("INCR", KEYS[3])
-  redis.call("SET", KEYS[1], "completed")
-  redis.call("PERSIST", KEYS[1])  -- or EXPIRE far into the future...
+  redis.call("SET", KEYS[1], "completed")  -- also clears the lock's ttl
   redis.call("ZREM", KEYS[2], KEYS[1])
 end
 """),
@@ -116,27 +113,26 @@ if ARGV[1] == redis.call("GET", KEYS[1]) then
 else return 0 end
 """),
 
-    # returns number of items {(queued + taken), completed}
-    # O(log(n))
-    lq_qsize_fast=dict(
-        keys=('Q', 'Qi'), args=(), script="""
-return {redis.call("ZCARD", KEYS[1]), redis.call("INCRBY", KEYS[2], 0)}
-"""),
-
-    # returns number of items {in_queue, taken, completed}
-    # O(n)  -- eek!
-    lq_qsize_slow=dict(
-        keys=('Q', 'Qi'), args=(), script="""
+    # returns number of items {(queued + taken), taken, completed}
+    # O(log(n)) if count_taken is 0, in which case taken is always 0.
+    # O(n) otherwise -- eek!  Reads the locks with one MGET per 1000 items
+    # rather than one GET per item.  (scores count how often an item was
+    # taken, so they can't tell us which items are taken right now)
+    lq_qsize=dict(
+        keys=('Q', 'Qi'), args=('count_taken', ), script="""
+local total = redis.call("ZCARD", KEYS[1])
 local taken = 0
-local queued = 0
-for _,k in ipairs(redis.call("ZRANGE", KEYS[1], 0, -1)) do
-  local v = redis.call("GET", k)
-  if "completed" ~= v then
-    if v then taken = taken + 1
-    else queued = queued + 1 end
+if "1" == ARGV[1] then
+  local ks = redis.call("ZRANGE", KEYS[1], 0, -1)
+  for i = 1, #ks, 1000 do
+    local vs = redis.call("MGET", unpack(ks, i, math.min(i + 999, #ks)))
+    for j = 1, #vs do
+      if "completed" == vs[j] then total = total - 1
+      elseif vs[j] then taken = taken + 1 end
+    end
   end
 end
-return {queued, taken, redis.call("INCRBY", KEYS[2], 0)}
+return {total, taken, redis.call("INCRBY", KEYS[2], 0)}
 """),
 
     # returns whether an item is in queue or currently being processed.
@@ -183,11 +179,14 @@ class LockingQueue(object):
         `queue_path` - a Redis key specifying where the queued items are
         """
         if mr_client._threadsafe:
-            self._client_id = random.randint(1, sys.maxsize)
+            self._client_id = util.new_client_id()
         else:
             self._client_id = mr_client._client_id
 
         self._mr = mr_client
+        util.load_scripts(
+            SCRIPTS, mr_client._map_async, mr_client._clients,
+            mr_client._quorum)
         self._params = dict(
             Q=queue_path, Qi=".%s" % queue_path,
             client_id=self._client_id)
@@ -210,25 +209,13 @@ class LockingQueue(object):
         """
         if not queued and not taken and not completed:
             raise UserWarning("At least one kwarg cannot be False")
-        if taken == queued:
-            counts = (x[1] for x in util.run_script(
-                SCRIPTS, self._mr._map_async,
-                'lq_qsize_fast', self._mr._clients, **(self._params))
-                if not isinstance(x[1], Exception))
-            if completed and taken:
-                return max(x[0] + x[1] for x in counts)
-            i = 0 if taken else 1
-            return max(x[i] for x in counts)
-
         counts = (x[1] for x in util.run_script(
-            SCRIPTS, self._mr._map_async,
-            'lq_qsize_slow', self._mr._clients, **(self._params))
+            SCRIPTS, self._mr._map_async, 'lq_qsize', self._mr._clients,
+            count_taken=int(taken != queued), **(self._params))
             if not isinstance(x[1], Exception))
-        i = 0 if queued else 1
-        if completed:
-            return max(x[2] + x[i] for x in counts)
-        else:
-            return max(x[i] for x in counts)
+        return max(
+            queued * (x[0] - x[1]) + taken * x[1] + completed * x[2]
+            for x in counts)
 
     def is_queued(self, h_k=None, item=None, taken=True, queued=True,
                   completed=False):
@@ -262,7 +249,7 @@ class LockingQueue(object):
                 if completed and str(taken_queued) == "already completed":
                     return True
                 nerrs += 1
-                if nerrs > self._mr._n_servers // 2:
+                if nerrs >= self._mr._quorum:
                     raise exceptions.NoMajority(
                         "Too many exceptions from Redis servers")
             elif taken and queued:
@@ -271,7 +258,7 @@ class LockingQueue(object):
                 cnt += taken_queued[0] == 1
             elif queued:
                 cnt += taken_queued[1] == 1
-            if cnt > self._mr._n_servers // 2:
+            if cnt >= self._mr._quorum:
                 return True
         return False
 
@@ -301,26 +288,18 @@ class LockingQueue(object):
             0 if otherwise failed to extend_lock
             number of seconds since epoch in the future when lock will expire
         """
-        _, t_expireat = util.get_expireat(self._mr._lock_timeout)
+        t_start, t_expireat = util.get_expireat(self._mr._lock_timeout)
         locks = list(util.run_script(
             SCRIPTS, self._mr._map_async, 'lq_extend_lock', self._mr._clients,
-            h_k=h_k, expireat=t_expireat, **(self._params)))
+            h_k=h_k, expireat=t_expireat,
+            ttl=util.get_ttl(t_start, t_expireat), **(self._params)))
         if not self._verify_not_already_completed(locks, h_k):
             return -1
+        # lq_extend_lock already re-locked the nodes where the lock expired,
+        # which recovers state if we lost the lock on any individual nodes but
+        # still have majority.  If we don't have majority, those get unlocked.
         if not self._have_majority(locks, h_k):
             return 0
-        # Re-lock nodes where lock is lost
-        # Recovers state if we lost the lock on any individual nodes but still
-        # have majority,  This could cause extend_lock to timeout more
-        # frequently, so it might not be a good idea if timeouts are very short
-        # on the other hand, if we remove the list(...) call, this could create
-        # a memory leak if polling_interval is too short.
-        if util.lock_still_valid(
-                t_expireat, self._mr._clock_drift, self._mr._polling_interval):
-            list(util.run_script(
-                SCRIPTS, self._mr._map_async, 'lq_lock',
-                [cli for cli, rv in locks if "%s" % rv == "expired"],
-                h_k=h_k, expireat=t_expireat, **(self._params)))
         return util.lock_still_valid(
             t_expireat, self._mr._clock_drift, self._mr._polling_interval)
 
@@ -379,7 +358,8 @@ class LockingQueue(object):
                                               backoff=lambda x: x + 1,
                                               condition=lambda x: x[0] >= 80))
         """
-        h_k = "%d:%f:%s" % (priority, time.time(), item)
+        # fixed width, integer microseconds since epoch
+        h_k = "%d:%016d:%s" % (priority, int(time.time() * 1e6), item)
         if retry_condition:
             put = retry_condition(self._put, lambda x: x[0] > 50)
         else:
@@ -387,12 +367,25 @@ class LockingQueue(object):
         return put(h_k)
 
     def _put(self, h_k):
-        rv = util.run_script(
-            SCRIPTS, self._mr._map_async, 'lq_put', self._mr._clients,
-            h_k=h_k, **self._params)
-        cnt = sum(x[1] == 1 for x in rv)
+        rv = self._mr._map_async(
+            lambda cli: self._put_one(cli, h_k), self._mr._clients)
+        cnt = sum(x == 1 for x in rv)
         return 100. * cnt / self._mr._n_servers, h_k
 
+    def _put_one(self, client, h_k):
+        """Queue h_k on one server without changing its score if it is already
+        queued there.  This is a single command, so it doesn't need a script.
+        Return 1 or the redis error"""
+        try:
+            client.execute_command('ZINCRBY', self._params['Q'], 0, h_k)
+        except redis.RedisError as err:
+            log.debug(
+                "Redis Error putting item", extra=dict(
+                    error=err, error_type=type(err).__name__,
+                    redis_client=client, h_k=h_k))
+            return err
+        return 1
+
     def get(self, extend_lock=True, check_all_servers=True):
         """
         Attempt to get an item from queue and obtain a lock on it to
@@ -417,7 +410,8 @@ class LockingQueue(object):
             1 / n_servers.  If True, we always preference the fastest response.
         """
         t_start, t_expireat = util.get_expireat(self._mr._lock_timeout)
-        client, h_k = self._get_candidate_keys(t_expireat, check_all_servers)
+        client, h_k = self._get_candidate_keys(
+            util.get_ttl(t_start, t_expireat), check_all_servers)
         if not h_k:
             return
         if self._acquire_lock_majority(client, h_k, t_start, t_expireat):
@@ -425,10 +419,11 @@ class LockingQueue(object):
                 util.continually_extend_lock_in_background(
                     h_k, self.extend_lock, self._mr._polling_interval,
                     self._mr._run_async, extend_lock, self._client_id)
-            priority, insert_time, item = h_k.decode().split(':', 2)
+            # h_k is priority:insert_time:item, and we only need the item
+            item = h_k[h_k.index(b':', h_k.index(b':') + 1) + 1:].decode()
             return item, h_k
 
-    def _get_candidate_keys(self, t_expireat, check_all_servers):
+    def _get_candidate_keys(self, ttl, check_all_servers):
         """Choose one server to get an item from.  Return (client, key)
 
         If `check_all_servers` is True, use the results from the first server
@@ -436,6 +431,9 @@ class LockingQueue(object):
         preferences the fastest server.  If the slowest server for some reason
         had keys that other servers didn't have, these keys would be less likely
         to get synced to the other servers.
+
+        Servers that locked a candidate which didn't win are not unlocked
+        here.  Their stale lock simply expires after `ttl` seconds.
         """
         if check_all_servers:
             clis = list(self._mr._clients)
@@ -444,23 +442,12 @@ class LockingQueue(object):
             clis = random.sample(self._mr._clients, 1)
         generator = util.run_script(
             SCRIPTS, self._mr._map_async,
-            'lq_get', clis, expireat=t_expireat, **self._params)
+            'lq_get', clis, ttl=ttl, **self._params)
 
-        failed_candidates = []
-        winner = (None, None)
         for cclient, ch_k in generator:
-            if isinstance(ch_k, Exception):
-                failed_candidates.append((cclient, ch_k))
-            else:
-                winner = (cclient, ch_k)
-                return winner
-        failed_clients = (
-            cclient for cclient, ch_k in chain(generator, failed_candidates))
-        list(util.run_script(
-            SCRIPTS, self._mr._map_async,
-            'lq_unlock', failed_clients,
-            h_k=ch_k, **(self._params)))
-        return winner
+            if not isinstance(ch_k, Exception):
+                return (cclient, ch_k)
+        return (None, None)
 
     def _acquire_lock_majority(self, client, h_k, t_start, t_expireat):
         """We've gotten and locked an item on a single redis instance.
@@ -469,10 +456,13 @@ class LockingQueue(object):
 
         Return True if acquired majority of locks, False otherwise.
         """
+        # Unlike Lock, wait for every server rather than stopping at quorum:
+        # a late "already completed" reply must still veto the lock.
         locks = util.run_script(
             SCRIPTS, self._mr._map_async, 'lq_lock',
             [x for x in self._mr._clients if x != client],
-            h_k=h_k, expireat=t_expireat, **(self._params))
+            h_k=h_k, expireat=t_expireat,
+            ttl=util.get_ttl(t_start, t_expireat), **(self._params))
         locks = list(locks)
         locks.append((client, 1))
         if not self._verify_not_already_completed(locks, h_k):
@@ -486,12 +476,13 @@ class LockingQueue(object):
 
     def _verify_not_already_completed(self, locks, h_k):
         """If any Redis server reported that the key, `h_k`, was completed,
-        return False and update all servers that don't know this fact.
+        return False and, in the background, update all servers that don't
+        know this fact.
         """
         locks = list(locks)
-        completed = ["%s" % l == "already completed" for _, l in locks]
-        if any(completed):
-            self._heal_completed(h_k, locks)
+        if any(isinstance(l, Exception) and str(l) == "already completed"
+               for _, l in locks):
+            self._mr._run_async(self._heal_completed, h_k, locks)
             return False
         return True
 
@@ -501,15 +492,17 @@ class LockingQueue(object):
 
         `locks` - a list of (client, have_lock) pairs.
             client is one of the redis clients
-            have_lock may be 0, 1 or an Exception
+            have_lock may be 0, 1, 2 or an Exception.  2 means the lock had
+            expired and was taken again, so it doesn't count towards majority
         """
-        cnt = sum(x[1] == 1 for x in locks if not isinstance(x, Exception))
-        if cnt < (self._mr._n_servers // 2 + 1):
+        locked_clients = [cli for cli, lock in locks if lock == 1]
+        if len(locked_clients) < self._mr._quorum:
+            locked_clients.extend(cli for cli, lock in locks if lock == 2)
             log.warn("Could not get majority of locks for item.", extra=dict(
                 h_k=h_k))
             list(util.run_script(
                 SCRIPTS, self._mr._map_async,
-                'lq_unlock', [cli for cli, lock in locks if lock == 1],
+                'lq_unlock', locked_clients,
                 h_k=h_k, **(self._params)))
             return False
         return True
@@ -520,7 +513,11 @@ class LockingQueue(object):
         exceptions"""
         outdated_clients = (
             cli for cli, rv in client_rv if not isinstance(rv, Exception))
-        list(util.run_script(
+        errs = [rv for _, rv in util.run_script(
             SCRIPTS, self._mr._map_async,
             'lq_completed', clients=outdated_clients,
-            h_k=h_k, **(self._params)))
+            h_k=h_k, **(self._params)) if isinstance(rv, Exception)]
+        if errs:
+            log.warn(
+                "Could not mark item completed on all servers",
+                extra=dict(h_k=h_k, errors=errs))
@@ -1,8 +1,9 @@
+import binascii
 from collections import defaultdict
 import functools
+import os
 import random
 import redis
-import sys
 import time
 
 from . import log
@@ -16,11 +17,17 @@ SHAS = defaultdict(dict)
 
 BACKGROUND_TASKS = {}
 
+# While a lock is extended in the background without trouble, multiply the
+# time between extensions by this much, up to the time the lock has left.
+EXTEND_LOCK_BACKOFF = 1.5
+
 
 def continually_extend_lock_in_background(
         h_k, extend_lock, polling_interval, run_async, callback, client_id):
     """
-    Extend the lock on given key, `h_k` every `polling_interval` seconds
+    Extend the lock on given key, `h_k`, every `polling_interval` seconds at
+    first, and then less often while extensions keep succeeding quickly.
+    See EXTEND_LOCK_BACKOFF.
 
     Once called, respawns itself indefinitely until extend_lock is unsuccessful
     """
@@ -37,7 +44,9 @@ def continually_extend_lock_in_background(
 
 def _continually_extend_lock_in_background(h_k, extend_lock, polling_interval,
                                            client_id):
+    interval = polling_interval
     while True:
+        t_start = time.time()
         secs_left = extend_lock(h_k)
         if (h_k, client_id) not in BACKGROUND_TASKS:
             log.debug(
@@ -52,8 +61,13 @@ def _continually_extend_lock_in_background(h_k, extend_lock, polling_interval,
                 " processing this item."), extra=dict(h_k=h_k))
         elif secs_left:
             assert secs_left > 0, "Code bug: secs_left cannot be negative"
-            time.sleep(
-                min(max(secs_left - polling_interval, 0), polling_interval))
+            if time.time() - t_start > polling_interval / 2.:
+                # a slow extend means a server or the network is struggling.
+                interval = polling_interval
+            # secs_left already leaves polling_interval to spare before the
+            # lock expires, so it bounds the sleep as is.
+            time.sleep(min(secs_left, interval))
+            interval = min(interval * EXTEND_LOCK_BACKOFF, secs_left)
             continue
         remove_background_thread(h_k, client_id)
         return
@@ -68,6 +82,12 @@ def remove_background_thread(h_k, client_id):
         callback(h_k)
 
 
+def new_client_id():
+    """Return a random id that identifies the owner of a lock.  It is bytes,
+    so redis-py doesn't encode it again every time it's sent to a server"""
+    return binascii.hexlify(os.urandom(16))
+
+
 def lock_still_valid(t_expireat, clock_drift, polling_interval):
     if t_expireat < 0:
         return False
@@ -83,6 +103,12 @@ def get_expireat(timeout):
     return t, int(t + timeout)
 
 
+def get_ttl(t_start, t_expireat):
+    """Return the number of seconds to pass to SET ... EX so that a key set
+    at or after `t_start` expires no earlier than `t_expireat`"""
+    return t_expireat - int(t_start)
+
+
 def _get_sha(scripts, script_name, client):
     try:
         rv = SHAS[script_name][client]
@@ -100,7 +126,37 @@ def _get_sha(scripts, script_name, client):
     return rv
 
 
-def _run_script(scripts, script_name, client, keys, args):
+def _load_scripts(scripts, client):
+    """Return True if every script is loaded on `client`.  Stop at the first
+    error, since the server is most likely down and every other script would
+    wait for the same timeout"""
+    for script_name in scripts:
+        if isinstance(_get_sha(scripts, script_name, client), Exception):
+            return False
+    return True
+
+
+def load_scripts(scripts, map_async, clients, quorum):
+    """Load and cache the sha of every script on every client, so the first
+    call to run_script doesn't also have to pay for a SCRIPT LOAD.
+    Clients are loaded in parallel with `map_async`.  Return as soon as
+    `quorum` clients have all the scripts.  A server that is down or slow
+    is left to finish in the background, and run_script loads whatever is
+    still missing"""
+    missing = [client for client in clients
+               if any(client not in SHAS[script_name]
+                      for script_name in scripts)]
+    n = len(clients) - len(missing)
+    if n >= quorum:
+        return
+    for is_loaded in map_async(
+            functools.partial(_load_scripts, scripts), missing):
+        n += is_loaded
+        if n >= quorum:
+            break
+
+
+def _run_script(scripts, script_name, client, keys, args, retry=True):
     sha = _get_sha(scripts, script_name, client)
     if isinstance(sha, Exception):
         return (client, sha)
@@ -110,25 +166,175 @@ def _run_script(scripts, script_name, client, keys, args):
         if isinstance(rv, list):
             rv = tuple(rv)
         return (client, rv)
-    except redis.exceptions.NoScriptError:
+    except redis.exceptions.NoScriptError as err:
         log.warn("server must have died since I've been running", extra=dict(
             redis_client=client, script_name=script_name))
-        del SHAS[script_name][client]
-        return _run_script(scripts, script_name, client, keys, args)
+        SHAS[script_name].pop(client, None)
+        if not retry:
+            return (client, err)
+        return _run_script(scripts, script_name, client, keys, args, False)
     except redis.exceptions.RedisError as err:
-        log.debug(
-            "Redis Error running script %s" % script_name,
-            extra=dict(
-                error=err, error_type=type(err).__name__,
-                redis_client=client, script_name=script_name,
-                script_keys=keys, script_args=args))
+        _log_script_error(err, script_name, client, keys, args)
         return (client, err)
 
 
+def _log_script_error(err, script_name, client, keys, args):
+    log.debug(
+        "Redis Error running script %s" % script_name,
+        extra=dict(
+            error=err, error_type=type(err).__name__,
+            redis_client=client, script_name=script_name,
+            script_keys=keys, script_args=args))
+
+
+class MultiplexedMap(object):
+    """
+    Wraps a map_async function.  run_script recognizes this wrapper and,
+    instead of mapping a blocking call over the clients, sends the script to
+    every client from the calling thread and reads the replies as they arrive.
+    Replies that the caller stops waiting for are read with `run_async`.
+    Anything else is mapped with the wrapped function.
+    """
+    def __init__(self, map_async, run_async):
+        self._map_async = map_async
+        self._run_async = run_async
+
+    def __call__(self, func, *iterables):
+        return self._map_async(func, *iterables)
+
+
+def _release(client, conn, disconnect=False):
+    if disconnect:
+        conn.disconnect()
+    client.connection_pool.release(conn)
+
+
+def _get_connection(client, command_name):
+    # redis-py 5.3 deprecated passing the command name, and older versions
+    # require it.
+    if redis.VERSION < (5, 3):
+        return client.connection_pool.get_connection(command_name)
+    return client.connection_pool.get_connection()
+
+
+def _multiplexed_run_script(scripts, run_async, script_name, clients, keys,
+                            args):
+    """Run a script on all clients using one thread.  Write the EVALSHA to
+    every client first, then read each reply once its socket is readable.
+    Yield (client, rv) pairs, like the other map_async implementations.
+
+    The first next() on the generator only writes the scripts and yields
+    None.  run_script does that before returning it, so the scripts run even
+    if the caller never reads the replies."""
+    # imported here so the default, threaded path still works on python 2
+    import selectors
+    selector = selectors.DefaultSelector()
+    pending = {}
+    failed = []
+    try:
+        for client in clients:
+            sha = _get_sha(scripts, script_name, client)
+            if isinstance(sha, Exception):
+                failed.append((client, sha))
+                continue
+            conn = None
+            try:
+                conn = _get_connection(client, 'EVALSHA')
+                conn.send_command('EVALSHA', sha, len(keys), *(keys + args))
+            except redis.exceptions.RedisError as err:
+                if conn is not None:
+                    _release(client, conn, disconnect=True)
+                _log_script_error(err, script_name, client, keys, args)
+                failed.append((client, err))
+                continue
+            selector.register(conn._sock, selectors.EVENT_READ, client)
+            pending[client] = conn
+        yield None
+
+        for client, err in failed:
+            yield (client, err)
+        timeouts = [conn.socket_timeout for conn in pending.values()]
+        timeout = None if None in timeouts else max(timeouts or [0])
+        while pending:
+            ready = selector.select(timeout)
+            if not ready:
+                break
+            for key, _ in ready:
+                client = key.data
+                selector.unregister(key.fileobj)
+                conn = pending.pop(client)
+                try:
+                    rv = conn.read_response()
+                except redis.exceptions.NoScriptError:
+                    # let the blocking path reload the script and retry
+                    _release(client, conn)
+                    SHAS[script_name].pop(client, None)
+                    yield _run_script(scripts, script_name, client, keys, args)
+                    continue
+                except redis.exceptions.ResponseError as err:
+                    _release(client, conn)
+                    _log_script_error(err, script_name, client, keys, args)
+                    yield (client, err)
+                    continue
+                except redis.exceptions.RedisError as err:
+                    _release(client, conn, disconnect=True)
+                    _log_script_error(err, script_name, client, keys, args)
+                    yield (client, err)
+                    continue
+                _release(client, conn)
+                if isinstance(rv, list):
+                    rv = tuple(rv)
+                yield (client, rv)
+
+        while pending:
+            client, conn = pending.popitem()
+            _release(client, conn, disconnect=True)
+            err = redis.exceptions.TimeoutError("Timeout reading from socket")
+            _log_script_error(err, script_name, client, keys, args)
+            yield (client, err)
+    finally:
+        selector.close()
+        if pending:
+            # the caller stopped early.  replies still in flight must be read
+            # before their connections can go back to the pool.
+            run_async(_drain_replies, scripts, script_name,
+                      list(pending.items()), keys, args)
+
+
+def _drain_replies(scripts, script_name, pending, keys, args):
+    """Read the replies that a caller of _multiplexed_run_script stopped
+    waiting for, log any errors and release the connections"""
+    for client, conn in pending:
+        try:
+            conn.read_response()
+        except redis.exceptions.NoScriptError:
+            _release(client, conn)
+            SHAS[script_name].pop(client, None)
+            _run_script(scripts, script_name, client, keys, args)
+        except redis.exceptions.ResponseError as err:
+            _release(client, conn)
+            _log_script_error(err, script_name, client, keys, args)
+        except redis.exceptions.RedisError as err:
+            _release(client, conn, disconnect=True)
+            _log_script_error(err, script_name, client, keys, args)
+        else:
+            _release(client, conn)
+
+
 def run_script(scripts, map_async, script_name, clients, **kwargs):
+    clients = list(clients)
+    if not clients:
+        # nothing to fan out to.  don't pay for a round of map_async
+        return iter(())
     keys = [kwargs[x] for x in scripts[script_name]['keys']]
-    args = [kwargs[x] if x != 'randint' else random.randint(1, sys.maxsize)
+    # randint stays below 2**53 so lua's doubles hold it exactly.
+    args = [kwargs[x] if x != 'randint' else random.randint(1, 2 ** 53)
             for x in scripts[script_name]['args']]
+    if isinstance(map_async, MultiplexedMap):
+        rvs = _multiplexed_run_script(
+            scripts, map_async._run_async, script_name, clients, keys, args)
+        next(rvs)  # send the script to every client now, like map_async
+        return rvs
     return map_async(
         lambda client: _run_script(scripts, script_name, client, keys, args),
         clients)